@@ -1,10 +1,13 @@
 
 
 import os
+import re
 import logging
-from flask import Flask, render_template, request, jsonify, send_file
+import orjson
+from urllib.parse import quote
+from flask import Flask, render_template, request, Response, stream_with_context
 from flask_compress import Compress
-from utils import get_video_info, download_video
+from utils import get_video_info, stream_video
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -12,38 +15,69 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__, static_folder='static', static_url_path='/static')
 app.secret_key = os.environ.get("SESSION_SECRET", "your-secret-key")
-# Add compression
+# Add compression, limited to text payloads (video is already compressed).
+# The deployment serves gunicorn directly, so this stays until a proxy is in front.
+app.config['COMPRESS_MIMETYPES'] = [
+    'application/json',
+    'text/html',
+    'application/xml',
+    'text/xml',
+    'text/css',
+    'application/javascript',
+]
+# Only gzip: COMPRESS_LEVEL doesn't apply to the zstd/br encodings Flask-Compress prefers by default
+app.config['COMPRESS_ALGORITHM'] = 'gzip'
+app.config['COMPRESS_LEVEL'] = 7
+app.config['COMPRESS_MIN_SIZE'] = 512
 Compress(app)
 
+# Small static files served from memory instead of hitting the filesystem per request
+def _read_static(filename):
+    with open(os.path.join(app.static_folder, filename), 'rb') as f:
+        return f.read()
+
+_ROBOTS = _read_static('robots.txt')
+_SITEMAP = _read_static('sitemap.xml')
+STATIC_CACHE_CONTROL = 'public, max-age=86400'
+
+def ojson(data, status=200):
+    """Serialize data to a JSON response with orjson."""
+    return Response(orjson.dumps(data), status=status, mimetype='application/json')
+
+def content_disposition(filename):
+    """Build an attachment header with an ASCII fallback and a UTF-8 filename."""
+    ascii_name = re.sub(r'[^\x20-\x7e]|["\\]', '_', filename)
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 @app.route('/robots.txt')
 def robots():
-    return send_file('static/robots.txt')
+    return Response(_ROBOTS, mimetype='text/plain', headers={'Cache-Control': STATIC_CACHE_CONTROL})
 
 @app.route('/sitemap.xml')
 def sitemap():
-    return send_file('static/sitemap.xml')
+    return Response(_SITEMAP, mimetype='application/xml', headers={'Cache-Control': STATIC_CACHE_CONTROL})
 
 @app.route('/fetch-info', methods=['POST'])
-def fetch_info():
+async def fetch_info():
     try:
         url = request.form.get('url')
         if not url:
             logger.error("Empty URL provided")
-            return jsonify({'error': 'Please provide a valid YouTube URL'}), 400
+            return ojson({'error': 'Please provide a valid YouTube URL'}, 400)
 
         # Log the URL being processed
         logger.info(f"Processing URL: {url}")
         
-        video_info = get_video_info(url)
+        video_info = await get_video_info(url)
         logger.info(f"Successfully fetched info for: {url}")
-        return jsonify(video_info)
+        return ojson(video_info)
     except Exception as e:
         logger.error(f"Error fetching video info: {str(e)}", exc_info=True)
-        return jsonify({'error': 'Failed to extract video information. Please check if the URL is valid.'}), 400
+        return ojson({'error': 'Failed to extract video information. Please check if the URL is valid.'}, 400)
 
 @app.route('/download', methods=['POST'])
 def download():
@@ -52,27 +86,19 @@ def download():
         format_id = request.form.get('format')
 
         if not url or not format_id:
-            return jsonify({'error': 'Missing URL or format'}), 400
+            return ojson({'error': 'Missing URL or format'}, 400)
 
         # Log the download request
         logger.info(f"Download requested for URL: {url} with format: {format_id}")
         
-        download_info = download_video(url, format_id)
+        filename = f"{request.form.get('title') or 'video'}.mp4"
+        stream = stream_video(url, format_id)
         
-        # Ensure the download directory exists
-        if not os.path.exists(download_info['filepath']):
-            logger.error(f"Download failed: File not found at {download_info['filepath']}")
-            return jsonify({'error': 'Downloaded file not found'}), 500
-            
-        logger.info(f"Download successful: {download_info['filename']}")
+        logger.info(f"Streaming download: {filename}")
         
-        # Set proper headers to help prevent false antivirus detections
-        response = send_file(
-            download_info['filepath'],
-            as_attachment=True,
-            download_name=download_info['filename'],
-            mimetype='video/mp4'
-        )
+        # Stream bytes from yt-dlp straight to the client
+        response = Response(stream_with_context(stream), mimetype='video/mp4')
+        response.headers['Content-Disposition'] = content_disposition(filename)
         
         # Add security headers
         response.headers['X-Content-Type-Options'] = 'nosniff'
@@ -83,4 +109,4 @@ def download():
     except Exception as e:
         error_message = str(e)
         logger.error(f"Error downloading video: {error_message}")
-        return jsonify({'error': error_message}), 400
+        return ojson({'error': error_message}, 400)
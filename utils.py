@@ -1,32 +1,65 @@
 import os
+import sys
+import json
 import logging
+import asyncio
+import multiprocessing
+import subprocess
+import tempfile
+import threading
 import yt_dlp
 import time
 import functools
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from urllib.parse import urlparse
+from lru import LRU
 
-# Simple in-memory cache for video info
-VIDEO_INFO_CACHE = {}
+# Bounded in-memory LRU cache for video info, keyed by normalized URL
+CACHE_MAX_ENTRIES = 1024
+VIDEO_INFO_CACHE = LRU(CACHE_MAX_ENTRIES)
 CACHE_EXPIRY = 3600  # 1 hour in seconds
+# Stale entries younger than this are served while a background refresh runs
+CACHE_STALE_MAX_AGE = 24 * 3600  # 24 hours in seconds
+# Raw yt-dlp info from recent extractions, reused by stream_video so a download
+# doesn't extract the video again. The stream URLs inside it expire after a few
+# hours, so entries are short-lived, and there are few of them because each is large.
+RAW_INFO_CACHE = LRU(64)
+RAW_INFO_MAX_AGE = 1800  # 30 minutes in seconds
+# Normalized URLs with a background refresh in flight
+_REFRESHING = set()
+_REFRESHING_LOCK = threading.Lock()
+
+# Player clients raced against each other when extracting video info
+PLAYER_CLIENTS = (['ios'], ['android'])
+# Cap concurrent upstream extractions across all requests to avoid YouTube 429s;
+# each request races every player client, so size the cap in whole requests
+MAX_CONCURRENT_REQUESTS = 4
+MAX_CONCURRENT_EXTRACTIONS = MAX_CONCURRENT_REQUESTS * len(PLAYER_CLIENTS)
+EXTRACTION_SEMAPHORE = threading.BoundedSemaphore(MAX_CONCURRENT_EXTRACTIONS)
+# Slot wait plus extraction (40s) must stay under gunicorn's --timeout (60s in .replit)
+EXTRACTION_QUEUE_TIMEOUT = 10  # seconds to wait for a free extraction slot
+EXTRACTION_TIMEOUT = 30  # seconds
+# yt-dlp parsing holds the GIL, so extractions run in worker processes. The pool
+# has one worker per slot so admitted jobs never queue, and workers come from a
+# forkserver rather than being forked from a threaded server process.
+def _new_executor():
+    return ProcessPoolExecutor(max_workers=MAX_CONCURRENT_EXTRACTIONS,
+                               mp_context=multiprocessing.get_context('forkserver'))
+
+EXECUTOR = _new_executor()
+# Guards replacing EXECUTOR after a worker process dies
+_EXECUTOR_LOCK = threading.Lock()
+
+# Hosts accepted as YouTube URLs
+_VALID_NETLOCS = frozenset(('www.youtube.com', 'youtube.com', 'youtu.be', 'm.youtube.com'))
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Create downloads directory if it doesn't exist
-DOWNLOAD_DIR = "downloads"
-if not os.path.exists(DOWNLOAD_DIR):
-    os.makedirs(DOWNLOAD_DIR)
-
 def is_valid_youtube_url(url):
-    try:
-        parsed = urlparse(url)
-        valid_domains = ['www.youtube.com', 'youtube.com', 'youtu.be', 'm.youtube.com']
-        return parsed.netloc in valid_domains
-    except Exception as e:
-        logger.error(f"URL validation error: {str(e)}")
-        return False
+    return urlparse(url).netloc in _VALID_NETLOCS
         
 def normalize_youtube_url(url):
     """Convert youtu.be URLs to full youtube.com URLs"""
@@ -58,7 +91,9 @@ def format_file_size(bytes):
     else:
         return f"{size_mb:.1f} MB"
 
+@functools.lru_cache(maxsize=256)
 def format_resolution(resolution):
+    """Format resolution to a user-friendly string."""
     if not resolution or resolution == 'N/A':
         return 'N/A'
     try:
@@ -87,7 +122,125 @@ def format_duration(seconds):
     except:
         return 'Unknown'
 
-def get_video_info(url):
+def _extract_info(url, player_client):
+    """Extract video info from YouTube using the given player clients."""
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': False,  # Show warnings
+        'skip_download': True,
+        'format': 'bestvideo+bestaudio/best',
+        'merge_output_format': 'mp4',
+        'nocheckcertificate': True,
+        'ignoreerrors': False,  # Don't ignore errors so we get detailed error messages
+        'geo_bypass': True,  # Try to bypass geo-restrictions
+        'no_check_certificate': True,
+        # Fail stalled connections so abandoned jobs can't hold pool workers indefinitely
+        'socket_timeout': EXTRACTION_TIMEOUT,
+        # Query a single lightweight player client instead of every client
+        'extractor_args': {'youtube': {'skip': ['webpage'], 'player_client': player_client}},
+    }
+
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            logger.info(f"Attempting to extract info with yt-dlp version: {yt_dlp.version.__version__} "
+                        f"(player client: {', '.join(player_client)})")
+            # Sanitize so the result only holds plain data that can be pickled back from the worker
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+    except Exception as e:
+        # yt-dlp's exceptions can't always be pickled back from the worker either
+        raise Exception(str(e)) from None
+
+    # Check if video info was properly extracted
+    if not info or not info.get('formats'):
+        raise Exception("Failed to extract video information. Please check if the URL is valid.")
+    return info
+
+def _submit_to_pool(fn, *args):
+    """Submit to EXECUTOR, replacing the pool once if a dead worker has broken it."""
+    global EXECUTOR
+    executor = EXECUTOR
+    try:
+        return executor.submit(fn, *args)
+    except BrokenProcessPool:
+        with _EXECUTOR_LOCK:
+            # Another request may have replaced it already
+            if EXECUTOR is executor:
+                logger.warning("Extraction pool is broken (a worker process died); starting a new one")
+                EXECUTOR = _new_executor()
+                executor.shutdown(wait=False, cancel_futures=True)
+            executor = EXECUTOR
+        return executor.submit(fn, *args)
+
+def _submit_extraction(url, player_client, wait):
+    """Submit _extract_info to the pool, or return None if no extraction slot is free.
+
+    The slot is held until the job itself finishes, so abandoned extractions
+    still count against the cap.
+    """
+    # Each request runs on its own event loop, so this bounded wait only delays this request
+    if not EXTRACTION_SEMAPHORE.acquire(timeout=EXTRACTION_QUEUE_TIMEOUT if wait else 0):
+        return None
+    try:
+        future = _submit_to_pool(_extract_info, url, player_client)
+    except BaseException:
+        EXTRACTION_SEMAPHORE.release()
+        raise
+    future.add_done_callback(lambda _: EXTRACTION_SEMAPHORE.release())
+    return future
+
+async def _extract_info_fastest(url):
+    """Race the player clients and return the first successful extraction."""
+    pending = set()
+    for client in PLAYER_CLIENTS:
+        # Wait for a slot for the first client; race the others only if slots are free
+        future = _submit_extraction(url, client, wait=not pending)
+        if future is None:
+            break
+        pending.add(asyncio.wrap_future(future))
+    if not pending:
+        raise Exception("Too many videos are being processed right now. Please try again shortly.")
+
+    error = None
+    try:
+        async with asyncio.timeout(EXTRACTION_TIMEOUT):
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                    logger.warning(f"Player client extraction failed for {url}: {str(error)}")
+    except TimeoutError:
+        logger.error(f"Timed out extracting info for video: {url}")
+        raise Exception(f"Timed out extracting video information after {EXTRACTION_TIMEOUT}s")
+    finally:
+        # Abandon the losers: they aren't on the loop's default executor, so
+        # asyncio.run() doesn't wait for them on shutdown
+        for task in pending:
+            task.cancel()
+    logger.error(f"Failed to extract info for video: {url}")
+    raise error
+
+def _refresh_video_info(url, normalized_url):
+    """Re-fetch video info in the background and update the cache."""
+    try:
+        asyncio.run(_fetch_video_info(url, normalized_url))
+        logger.info(f"Refreshed cached info for video: {normalized_url}")
+    except Exception as e:
+        logger.error(f"Background refresh failed for {normalized_url}: {str(e)}")
+    finally:
+        with _REFRESHING_LOCK:
+            _REFRESHING.discard(normalized_url)
+
+def _schedule_refresh(url, normalized_url):
+    """Start a background refresh unless one is already running for this URL."""
+    with _REFRESHING_LOCK:
+        if normalized_url in _REFRESHING:
+            return
+        _REFRESHING.add(normalized_url)
+    threading.Thread(target=_refresh_video_info, args=(url, normalized_url), daemon=True).start()
+
+async def get_video_info(url):
     """Get information about a YouTube video."""
     if not is_valid_youtube_url(url):
         raise ValueError("Not a valid YouTube URL")
@@ -98,186 +251,195 @@ def get_video_info(url):
     
     # Check cache first
     current_time = time.time()
-    if normalized_url in VIDEO_INFO_CACHE:
-        cache_time, cache_data = VIDEO_INFO_CACHE[normalized_url]
-        if current_time - cache_time < CACHE_EXPIRY:
+    # Single lookups only: refresh threads and other requests update the cache concurrently
+    entry = VIDEO_INFO_CACHE.get(normalized_url)
+    if entry is not None:
+        cache_time, cache_data = entry
+        age = current_time - cache_time
+        if age < CACHE_EXPIRY:
             logger.info(f"Using cached info for video: {normalized_url}")
             return cache_data
+        if age < CACHE_STALE_MAX_AGE:
+            # Serve the stale entry now and refresh it off the request path
+            logger.info(f"Using stale cached info for video: {normalized_url}")
+            _schedule_refresh(url, normalized_url)
+            return cache_data
+        # Too old to serve; drop it so it doesn't occupy an LRU slot
+        VIDEO_INFO_CACHE.pop(normalized_url, None)
 
+    return await _fetch_video_info(url, normalized_url)
+
+async def _fetch_video_info(url, normalized_url):
+    """Extract video info, format it for display and cache the result."""
     try:
         logger.info(f"Fetching info for video: {normalized_url}")
+        info = await _extract_info_fastest(normalized_url)
 
-        ydl_opts = {
-            'quiet': False,  # Enable output for debugging
-            'no_warnings': False,  # Show warnings
-            'skip_download': True,
-            'format': 'bestvideo+bestaudio/best',
-            'merge_output_format': 'mp4',
-            'nocheckcertificate': True,
-            'ignoreerrors': False,  # Don't ignore errors so we get detailed error messages
-            'verbose': True,  # More detailed output
-            'geo_bypass': True,  # Try to bypass geo-restrictions
-            'no_check_certificate': True,
-            'prefer_insecure': True,
-            'allow_unplayable_formats': True,
-            'extractor_args': {'youtube': {'skip': ['webpage']}},
-        }
+        # Only select these key resolutions
+        priority_heights = [360, 480, 720, 1080]
+        priority_formats = {}
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            logger.info(f"Attempting to extract info with yt-dlp version: {yt_dlp.version.__version__}")
-            info = ydl.extract_info(normalized_url, download=False)
+        # Organize formats by height
+        for f in info.get('formats', []):
+            if f.get('vcodec') == 'none':
+                continue
+            resolution = f.get('resolution', 'N/A')
+            ext = f.get('ext', 'N/A')
+            format_id = f.get('format_id', '')
+            filesize = f.get('filesize')
+            height = f.get('height')
+            if height:
+                height = int(height)
+                # Only process if the height is in our priority list
+                if height in priority_heights:
+                    quality = f"{format_resolution(resolution)} ({ext})"
+                    if height not in priority_formats:
+                        priority_formats[height] = []
+                    priority_formats[height].append({
+                        'format_id': format_id,
+                        'quality': quality,
+                        'ext': ext,
+                        'resolution': resolution,
+                        'filesize': format_file_size(filesize) if filesize else 'Unknown MB',
+                        'filesize_bytes': filesize or 0
+                    })
+
+        # Add only the best format for each resolution
+        formats = []
+        for height in priority_heights:
+            if height in priority_formats:
+                # Prefer MP4 format
+                mp4_formats = [f for f in priority_formats[height] if f['ext'] == 'mp4']
+                if mp4_formats:
+                    # Take the best MP4 format (usually with the largest filesize)
+                    best_format = max(mp4_formats, key=lambda x: x['filesize_bytes'])
+                    formats.append(best_format)
+                else:
+                    # If no MP4, take the best available format
+                    formats.append(priority_formats[height][0])
+
+        # Map format IDs to audio codecs so audio checks are O(1) lookups
+        acodec_by_id = {f.get('format_id'): f.get('acodec') for f in info.get('formats', [])}
+
+        # Format the data for display
+        formatted_formats = []
+        for fmt in formats:
+            # Extract height only for display (like "360p" instead of full resolution)
+            resolution_display = format_resolution(fmt['resolution'])
             
-            # Check if video info was properly extracted
-            if info is None:
-                logger.error(f"Failed to extract info for video: {url}")
-                raise Exception("Failed to extract video information. Please check if the URL is valid.")
-
-            # Only select these key resolutions
-            priority_heights = [360, 480, 720, 1080]
-            priority_formats = {}
-
-            # Organize formats by height
-            for f in info.get('formats', []):
-                if f.get('vcodec') == 'none':
-                    continue
-                resolution = f.get('resolution', 'N/A')
-                ext = f.get('ext', 'N/A')
-                format_id = f.get('format_id', '')
-                filesize = f.get('filesize')
-                height = f.get('height')
-                if height:
-                    height = int(height)
-                    # Only process if the height is in our priority list
-                    if height in priority_heights:
-                        quality = f"{format_resolution(resolution)} ({ext})"
-                        if height not in priority_formats:
-                            priority_formats[height] = []
-                        priority_formats[height].append({
-                            'format_id': format_id,
-                            'quality': quality,
-                            'ext': ext,
-                            'resolution': resolution,
-                            'filesize': format_file_size(filesize) if filesize else 'Unknown MB'
-                        })
-
-            # Add only the best format for each resolution
-            formats = []
-            for height in priority_heights:
-                if height in priority_formats:
-                    # Prefer MP4 format
-                    mp4_formats = [f for f in priority_formats[height] if f['ext'] == 'mp4']
-                    if mp4_formats:
-                        # Take the best MP4 format (usually with the largest filesize)
-                        best_format = sorted(mp4_formats, 
-                                           key=lambda x: float(x['filesize'].split()[0]) if 'Unknown' not in x['filesize'] else 0, 
-                                           reverse=True)[0]
-                        formats.append(best_format)
-                    else:
-                        # If no MP4, take the best available format
-                        formats.append(priority_formats[height][0])
-
-            # Format the data for display
-            formatted_formats = []
-            for fmt in formats:
-                # Extract height only for display (like "360p" instead of full resolution)
-                resolution_display = format_resolution(fmt['resolution'])
-                
-                # Check if format has audio
-                has_audio = False
-                for f in info.get('formats', []):
-                    if f.get('format_id') == fmt['format_id'] and f.get('acodec') != 'none':
-                        has_audio = True
-                        break
-                
-                # Check if it's a YouTube Shorts URL
-                is_shorts = '/shorts/' in url
-                
-                formatted_formats.append({
-                    'format_id': fmt['format_id'],
-                    'quality': f"{resolution_display}" if fmt['ext'] == 'mp4' else f"{resolution_display} ({fmt['ext']})",
-                    'extension': fmt['ext'],
-                    'filesize': fmt['filesize'] if fmt['filesize'] != 'Unknown MB' else '0 MB',
-                    'has_audio': True if is_shorts else has_audio
-                })
-
-            result = {
-                'title': info.get('title', 'Unknown Title'),
-                'thumbnail': info.get('thumbnail', ''),
-                'duration': info.get('duration'),
-                'uploader': info.get('uploader', 'Unknown Uploader'),
-                'formats': formatted_formats
-            }
+            # Check if format has audio
+            has_audio = acodec_by_id.get(fmt['format_id'], 'none') != 'none'
             
-            # Cache the result
-            VIDEO_INFO_CACHE[url] = (time.time(), result)
+            # Check if it's a YouTube Shorts URL
+            is_shorts = '/shorts/' in url
             
-            return result
+            formatted_formats.append({
+                'format_id': fmt['format_id'],
+                'quality': f"{resolution_display}" if fmt['ext'] == 'mp4' else f"{resolution_display} ({fmt['ext']})",
+                'extension': fmt['ext'],
+                'filesize': fmt['filesize'] if fmt['filesize'] != 'Unknown MB' else '0 MB',
+                'has_audio': True if is_shorts else has_audio
+            })
+
+        result = {
+            'title': info.get('title', 'Unknown Title'),
+            'thumbnail': info.get('thumbnail', ''),
+            'duration': info.get('duration'),
+            'uploader': info.get('uploader', 'Unknown Uploader'),
+            'formats': formatted_formats
+        }
+        
+        # Cache the result, and the raw info for a follow-up download
+        VIDEO_INFO_CACHE[normalized_url] = (time.time(), result)
+        RAW_INFO_CACHE[normalized_url] = (time.time(), info)
+        
+        return result
 
     except Exception as e:
         logger.error(f"Error fetching video info: {str(e)}")
         raise Exception(f"Error fetching video info: {str(e)}")
 
-def format_resolution(resolution):
-    """Format resolution to a user-friendly string."""
-    if not resolution or resolution == 'N/A':
-        return 'N/A'
-    try:
-        if 'x' in resolution:
-            height = resolution.split('x')[1]
-            return f"{height}p"
-        return resolution
-    except:
-        return resolution
+STREAM_CHUNK_SIZE = 65536
 
-def download_video(url, format_id):
-    """Download video with the specified format."""
-    try:
-        # Normalize the URL first
-        normalized_url = normalize_youtube_url(url)
-        logger.info(f"Downloading video: {normalized_url} with format: {format_id}")
-
-        # Create a timestamp for unique filenames
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-
-        # Configure yt-dlp options with metadata to prevent false positives
-        ydl_opts = {
-            'format': f"{format_id}+bestaudio[ext=m4a]/best",  # Add best audio to the video format
-            'outtmpl': f'{DOWNLOAD_DIR}/%(title)s-{timestamp}.%(ext)s',
-            'addmetadata': True,  # Add metadata to file
-            'writethumbnail': False,  # Don't write thumbnail
-            'quiet': False,  # Show progress
-            'no_warnings': False,
-            # Skip cookie loading as it's causing errors
-            # 'cookiesfrombrowser': ('chrome',),
-            # 'cookiefile': 'youtube.com_cookies.txt',
-            'nocheckcertificate': True,
-            'ignoreerrors': True,
-            'extractor_args': {'youtube': {'skip': ['webpage']}},
-            'postprocessors': [{
-                'key': 'FFmpegEmbedSubtitle'
-            }, {
-                'key': 'FFmpegVideoConvertor',
-                'preferedformat': 'mp4'
-            }, {
-                'key': 'FFmpegMetadata'
-            }],
-        }
+def _start_stream(format_id, source_args):
+    """Start yt-dlp writing the video to stdout and read its first chunk.
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(normalized_url, download=True)
-            if info is None:
-                logger.error(f"Failed to extract info for download: {normalized_url}")
-                raise Exception("Failed to extract video information for download. Please check if the URL is valid.")
-            downloaded_file = ydl.prepare_filename(info)
-
-        # Get just the filename without the directory
-        filename = os.path.basename(downloaded_file)
-
-        return {
-            'filepath': downloaded_file,
-            'filename': filename
-        }
+    The chunk is empty if yt-dlp produced no output, in which case the
+    process has already been reaped.
+    """
+    # Use the same player clients as get_video_info so the offered format IDs exist here
+    player_clients = ','.join(client for clients in PLAYER_CLIENTS for client in clients)
 
-    except Exception as e:
-        logger.error(f"Error downloading video: {str(e)}")
-        raise Exception(f"Error downloading video: {str(e)}")
+    cmd = [
+        sys.executable, '-m', 'yt_dlp',
+        '--format', f"{format_id}+bestaudio[ext=m4a]/best",
+        '--merge-output-format', 'mp4',
+        # ffmpeg writes MPEG-TS when merging to stdout; force fragmented MP4 instead
+        '--downloader-args', 'ffmpeg:-movflags frag_keyframe+empty_moov -f mp4',
+        '--no-check-certificates',
+        '--extractor-args', f"youtube:skip=webpage;player_client={player_clients}",
+        '--quiet',
+        '--output', '-',
+        *source_args,
+    ]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+    first_chunk = proc.stdout.read(STREAM_CHUNK_SIZE)
+    if not first_chunk:
+        proc.wait()
+        proc.stdout.close()
+    return proc, first_chunk
+
+def stream_video(url, format_id):
+    """Stream video bytes from yt-dlp's stdout without writing to disk.
+
+    If /fetch-info extracted this video recently, its raw info is handed to
+    yt-dlp so the download doesn't probe YouTube again. The first chunk is
+    read before returning so that extraction errors surface as exceptions
+    instead of an empty response.
+    """
+    if not is_valid_youtube_url(url):
+        raise ValueError("Not a valid YouTube URL")
+
+    normalized_url = normalize_youtube_url(url)
+    logger.info(f"Streaming video: {normalized_url} with format: {format_id}")
+
+    first_chunk = b''
+    cached = RAW_INFO_CACHE.get(normalized_url)
+    if cached is not None and time.time() - cached[0] < RAW_INFO_MAX_AGE:
+        with tempfile.NamedTemporaryFile('w', suffix='.info.json', delete=False) as f:
+            json.dump(cached[1], f)
+        try:
+            proc, first_chunk = _start_stream(format_id, ['--load-info-json', f.name])
+        finally:
+            # yt-dlp has read the file by the time it writes output or exits
+            os.unlink(f.name)
+        if first_chunk:
+            logger.info(f"Streaming from cached info for: {normalized_url}")
+        else:
+            logger.warning(f"Cached info failed for {normalized_url} (exit code {proc.returncode}); re-extracting")
+            RAW_INFO_CACHE.pop(normalized_url, None)
+
+    if not first_chunk:
+        # End option parsing so the URL can never be read as a yt-dlp option
+        proc, first_chunk = _start_stream(format_id, ['--', normalized_url])
+        if not first_chunk:
+            logger.error(f"yt-dlp produced no output for {normalized_url} (exit code {proc.returncode})")
+            raise Exception("Error downloading video: no data received from yt-dlp")
+
+    def generate():
+        try:
+            chunk = first_chunk
+            while chunk:
+                yield chunk
+                chunk = proc.stdout.read(STREAM_CHUNK_SIZE)
+        finally:
+            # Stop yt-dlp if the client disconnected mid-stream
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            returncode = proc.wait()
+            if returncode not in (0, -9):
+                logger.error(f"yt-dlp exited with code {returncode} while streaming {normalized_url}")
+
+    return generate()